@@ -7,11 +7,18 @@ Flask backend for the Network Cell Analyzer
 • Auto-migrates the DB to add `device_id` column if missing
 """
 
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, render_template
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text
-from datetime import datetime
-import pytz
+from sqlalchemy import event, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from datetime import datetime, timedelta
+from functools import lru_cache
+import orjson
+import queue
+import re
+import threading
+import time
+from zoneinfo import ZoneInfo
 
 # ───────────────────────────────────────
 # CONFIG
@@ -19,8 +26,23 @@ import pytz
 app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///network_data.db"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# Tuned for the gunicorn gthread worker: a warm pool shared across threads
+# so concurrent /get-stats reads hit the WAL snapshot in parallel instead of
+# paying a connection handshake per request.
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_size": 8,
+    "max_overflow": 4,
+    # a local SQLite file can't drop connections, so skip the per-checkout
+    # liveness ping
+    "pool_pre_ping": False,
+    # roomy compiled-statement cache: every stats variant stays compiled
+    "query_cache_size": 1200,
+    "connect_args": {"check_same_thread": False, "timeout": 30},
+}
 db = SQLAlchemy(app)
-lebanon_tz = pytz.timezone("Asia/Beirut")
+# stdlib zoneinfo: no pytz localize/normalize dance, C-backed conversions
+lebanon_tz = ZoneInfo("Asia/Beirut")
+utc_tz     = ZoneInfo("UTC")
 
 # ───────────────────────────────────────
 # MODELS
@@ -34,7 +56,35 @@ class CellData(db.Model):
     network_type = db.Column(db.String(10))
     band         = db.Column(db.String(20))
     cell_id      = db.Column(db.String(50))
-    timestamp    = db.Column(db.DateTime, index=True)
+    timestamp    = db.Column(db.DateTime)  # covered by the composite indexes below
+
+    __table_args__ = (
+        # /get-stats filters on device_id + timestamp range; a composite
+        # index lets SQLite do a single B-tree range seek.
+        db.Index("idx_cell_device_ts", "device_id", "timestamp"),
+        # Covering index: /get-stats/avg-all aggregates signal_power/snr
+        # over a timestamp range without touching the table heap.
+        db.Index("idx_cell_ts_cover", "timestamp", "signal_power", "snr"),
+        # Covers the per-device GROUP BY aggregation entirely from the index
+        # (no heap fetch per matching row).
+        db.Index("idx_cell_stats_cover", "device_id", "timestamp",
+                 "operator", "network_type", "signal_power", "snr"),
+    )
+
+class CellDataHourly(db.Model):
+    """Pre-aggregated rollup of cell_data per (device, hour, operator, network).
+
+    Maintained by the ingest flusher; the stats queries sum over these few
+    rows instead of rescanning raw telemetry for every dashboard poll.
+    """
+    __tablename__ = "cell_data_hourly"
+    device_id    = db.Column(db.String(64), primary_key=True)
+    hour_ts      = db.Column(db.DateTime, primary_key=True)
+    operator     = db.Column(db.String(50), primary_key=True)
+    network_type = db.Column(db.String(10), primary_key=True)
+    n            = db.Column(db.Integer, nullable=False, default=0)
+    sum_sig      = db.Column(db.Integer, nullable=False, default=0)
+    sum_snr      = db.Column(db.Float, nullable=False, default=0.0)
 
 class DeviceLog(db.Model):
     id         = db.Column(db.Integer, primary_key=True)
@@ -46,76 +96,408 @@ class DeviceLog(db.Model):
 # DB INITIALISATION & SELF-MIGRATION
 # ───────────────────────────────────────
 with app.app_context():
+    # Most pragmas are per-connection, so set them on every connection the
+    # pool opens, not just the first: WAL lets readers run while the flusher
+    # writes, NORMAL sync keeps one fsync per batch, busy_timeout avoids
+    # "database is locked" errors under concurrent threads.
+    @event.listens_for(db.engine, "connect")
+    def _set_sqlite_pragmas(dbapi_conn, _record):
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA busy_timeout=5000")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.execute("PRAGMA mmap_size=268435456")
+        cur.close()
+
     db.create_all()
 
-    # If the user forgot to run ALTER TABLE, add device_id automatically
-    col_names = [
-        row[1]
-        for row in db.session.execute(text("PRAGMA table_info(cell_data)")).fetchall()
-    ]
-    if "device_id" not in col_names:
-        db.session.execute("ALTER TABLE cell_data ADD COLUMN device_id VARCHAR(64)")
+    # One-off migrations are gated on PRAGMA user_version so boots after the
+    # first don't rescan table_info. Pre-versioned DBs that already have the
+    # column just get their version stamped.
+    if db.session.execute(text("PRAGMA user_version")).scalar() < 1:
+        col_names = [
+            row[1]
+            for row in db.session.execute(text("PRAGMA table_info(cell_data)")).fetchall()
+        ]
+        if "device_id" not in col_names:
+            db.session.execute(text("ALTER TABLE cell_data ADD COLUMN device_id VARCHAR(64)"))
+            print("➕  Added missing column `device_id` to cell_data")
+        db.session.execute(text("PRAGMA user_version = 1"))
         db.session.commit()
-        print("➕  Added missing column `device_id` to cell_data")
 
+    # Composite index for the /get-stats hot path (pre-existing DBs miss it)
+    db.session.execute(
+        text("CREATE INDEX IF NOT EXISTS idx_cell_device_ts ON cell_data(device_id, timestamp)")
+    )
+    db.session.execute(
+        text("CREATE INDEX IF NOT EXISTS idx_cell_ts_cover ON cell_data(timestamp, signal_power, snr)")
+    )
+    db.session.execute(
+        text("CREATE INDEX IF NOT EXISTS idx_cell_stats_cover ON cell_data"
+             "(device_id, timestamp, operator, network_type, signal_power, snr)")
+    )
+    # Backfill the hourly rollup from pre-existing raw rows (one time).
+    # The literal '.000000' keeps hour_ts strings identical to the ones the
+    # Python flusher writes, so upserts and range filters line up. Rows from
+    # before the device_id migration have NULL device_id, which the rollup's
+    # NOT NULL primary key rejects — map them to '' so they still count in
+    # the global avg-all totals.
+    if db.session.execute(text("SELECT 1 FROM cell_data_hourly LIMIT 1")).first() is None:
+        db.session.execute(text(
+            "INSERT INTO cell_data_hourly "
+            "(device_id, hour_ts, operator, network_type, n, sum_sig, sum_snr) "
+            "SELECT COALESCE(device_id, ''), "
+            "strftime('%Y-%m-%d %H:00:00.000000', timestamp), "
+            "operator, network_type, COUNT(*), SUM(signal_power), SUM(snr) "
+            "FROM cell_data GROUP BY 1, 2, 3, 4"
+        ))
+
+    # The composite indexes supersede the old single-column timestamp index;
+    # keeping it only slows inserts and can mislead the planner.
+    db.session.execute(text("DROP INDEX IF EXISTS ix_cell_data_timestamp"))
+
+    db.session.execute(text("ANALYZE"))  # refresh planner stats so the index is used
+    db.session.commit()
+
+
+# ───────────────────────────────────────
+# INGEST QUEUE
+# ───────────────────────────────────────
+# /receive-data enqueues; a background thread drains the queue and writes
+# one batched INSERT (+ DeviceLog updates) per flush, so SQLite pays one
+# fsync per batch instead of one per request.
+_INGEST_FLUSH_INTERVAL = 0.25   # seconds
+_INGEST_FLUSH_MAX      = 500    # rows per flush
+_ingest_q = queue.Queue()
+
+def _flush_ingest_batch(batch):
+    rows = [item["row"] for item in batch]
+    with app.app_context():
+        try:
+            db.session.execute(CellData.__table__.insert(), rows)
+
+            # fold the batch into the hourly rollup in the same transaction
+            hourly = {}
+            for r in rows:
+                key = (r["device_id"],
+                       r["timestamp"].replace(minute=0, second=0, microsecond=0),
+                       r["operator"], r["network_type"])
+                agg = hourly.setdefault(key, [0, 0, 0.0])
+                agg[0] += 1
+                agg[1] += r["signal_power"]
+                agg[2] += r["snr"]
+            for (dev_id, hour_ts, op, nt), (n, ssig, ssnr) in hourly.items():
+                stmt = (sqlite_insert(CellDataHourly)
+                        .values(device_id=dev_id, hour_ts=hour_ts, operator=op,
+                                network_type=nt, n=n, sum_sig=ssig, sum_snr=ssnr))
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=["device_id", "hour_ts", "operator", "network_type"],
+                    set_={"n": CellDataHourly.n + stmt.excluded.n,
+                          "sum_sig": CellDataHourly.sum_sig + stmt.excluded.sum_sig,
+                          "sum_snr": CellDataHourly.sum_snr + stmt.excluded.sum_snr})
+                db.session.execute(stmt)
+
+            # collapse to one DeviceLog upsert per IP (latest wins);
+            # no SELECT round-trip, the conflict clause does the update
+            latest = {}
+            for item in batch:
+                latest[item["ip"]] = (item["row"]["device_id"], item["last_seen"])
+            for ip, (dev_id, seen) in latest.items():
+                stmt = (sqlite_insert(DeviceLog)
+                        .values(ip_address=ip, device_id=dev_id, last_seen=seen)
+                        .on_conflict_do_update(
+                            index_elements=["ip_address"],
+                            set_={"device_id": dev_id, "last_seen": seen}))
+                db.session.execute(stmt)
+
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"⚠️  Ingest flush failed ({len(batch)} rows): {e}")
+
+def _ingest_flusher():
+    while True:
+        try:
+            first = _ingest_q.get(timeout=_INGEST_FLUSH_INTERVAL)
+        except queue.Empty:
+            continue
+        batch = [first]
+        deadline = time.monotonic() + _INGEST_FLUSH_INTERVAL
+        while len(batch) < _INGEST_FLUSH_MAX:
+            try:
+                batch.append(_ingest_q.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        _flush_ingest_batch(batch)
+
+# Started lazily on first enqueue rather than at import: under gunicorn
+# --preload the module is imported in the master process, and a thread
+# started there would not survive the fork into workers.
+_flusher_started = threading.Event()
+_flusher_start_lock = threading.Lock()
+
+def _ensure_flusher():
+    if _flusher_started.is_set():
+        return
+    with _flusher_start_lock:
+        if not _flusher_started.is_set():
+            threading.Thread(target=_ingest_flusher, name="ingest-flusher",
+                             daemon=True).start()
+            _flusher_started.set()
 
 # ───────────────────────────────────────
 # HELPER UTILS (return dict, code)
 # ───────────────────────────────────────
+# Precompiled parser for the fixed "%d %b %Y %I:%M %p" wire format.
+# strptime re-tokenizes the format string on every call; a single regex
+# match plus month/AM-PM lookup is ~10x faster on this hot path.
+_TS_RE = re.compile(r"(\d{1,2}) ([A-Za-z]{3}) (\d{4}) (\d{1,2}):(\d{2}) (AM|PM)\s*$")
+_MONTHS = {"Jan":1,"Feb":2,"Mar":3,"Apr":4,"May":5,"Jun":6,
+           "Jul":7,"Aug":8,"Sep":9,"Oct":10,"Nov":11,"Dec":12}
+
+@lru_cache(maxsize=4096)
+def parse_ts(s):
+    # memoized: clients re-send the same minute-granularity stamp many times
+    if len(s) == 20 and s[2] == " " and s[17] == " " and s[18:20] in ("AM", "PM"):
+        # fast path: fixed-width "dd Mon yyyy hh:mm AM" — pure slicing,
+        # no regex engine involved
+        try:
+            hour = int(s[12:14])
+            if 1 <= hour <= 12:  # %I only admits 01-12
+                hour %= 12
+                if s[18:20] == "PM":
+                    hour += 12
+                return datetime(int(s[7:11]), _MONTHS[s[3:6]], int(s[0:2]),
+                                hour, int(s[15:17]))
+        except (ValueError, KeyError):
+            pass  # oddly-formed but maybe still parseable below
+    m = _TS_RE.match(s)
+    if not m:
+        raise ValueError(f"time data {s!r} does not match format '%d %b %Y %I:%M %p'")
+    day, mon, year, hour, minute, ampm = m.groups()
+    month = _MONTHS.get(mon.title())
+    if month is None:
+        raise ValueError(f"time data {s!r} does not match format '%d %b %Y %I:%M %p'")
+    hour = int(hour)
+    if not 1 <= hour <= 12:  # %I only admits 01-12
+        raise ValueError(f"time data {s!r} does not match format '%d %b %Y %I:%M %p'")
+    hour %= 12
+    if ampm == "PM":
+        hour += 12
+    return datetime(int(year), month, int(day), hour, int(minute))
+
 def _to_utc(ds, default):
     if not ds:
         return default
-    return lebanon_tz.localize(datetime.strptime(ds, "%d %b %Y %I:%M %p")).astimezone(pytz.utc)
-
-def get_stats_inner(device_id, start=None, end=None):
+    return parse_ts(ds).replace(tzinfo=lebanon_tz).astimezone(utc_tz)
+
+# min/max(timestamp) are needed only to default missing start/end dates;
+# cache them briefly instead of running two aggregate queries per request.
+_TS_BOUNDS_TTL = 15  # seconds
+_ts_bounds_cache = {"value": None, "expires": 0.0}
+_ts_bounds_lock = threading.Lock()
+
+def _ts_bounds():
+    now = time.monotonic()
+    with _ts_bounds_lock:
+        if _ts_bounds_cache["value"] is not None and now < _ts_bounds_cache["expires"]:
+            return _ts_bounds_cache["value"]
     first = db.session.query(db.func.min(CellData.timestamp)).scalar()
     last  = db.session.query(db.func.max(CellData.timestamp)).scalar()
-    if first is None:
-        return {"message":"No data"},404
-
-    s,e = _to_utc(start,first), _to_utc(end,last)
+    with _ts_bounds_lock:
+        _ts_bounds_cache["value"] = (first, last)
+        _ts_bounds_cache["expires"] = now + _TS_BOUNDS_TTL
+    return first, last
+
+def _parse_range(start, end):
+    """Resolve (start, end) query params to a UTC range.
+
+    Skips the min/max bounds lookup entirely when both dates are given.
+    Returns (s, e) or an (error dict, code) tuple.
+    """
+    if start and end:
+        s, e = _to_utc(start, None), _to_utc(end, None)
+    else:
+        first, last = _ts_bounds()
+        if first is None:
+            return {"message":"No data"},404
+        s, e = _to_utc(start, first), _to_utc(end, last)
     if e < s:
         return {"error":"End date must be after start date"},400
+    return s, e
+
+def _hour_floor(dt):
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+def _hour_ceil(dt):
+    floored = _hour_floor(dt)
+    return floored if floored == dt else floored + timedelta(hours=1)
+
+def _merge_agg(op_cnt, net_agg, op_rows, net_rows):
+    for k, n in op_rows:
+        op_cnt[k] = op_cnt.get(k, 0) + n
+    for k, n, ssig, ssnr in net_rows:
+        agg = net_agg.setdefault(k, [0, 0, 0.0])
+        agg[0] += n
+        agg[1] += ssig or 0
+        agg[2] += ssnr or 0.0
+
+def _device_aggregates(device_id, s, e):
+    """Per-operator counts and per-network [n, sum_sig, sum_snr] for [s, e].
+
+    Full interior hours come from the cell_data_hourly rollup; only the
+    partial hours at the range edges rescan raw cell_data rows.
+    """
+    op_cnt, net_agg = {}, {}
+    lo, hi = _hour_ceil(s), _hour_floor(e)
+
+    def add_raw(lo_ts, hi_ts, inclusive_end):
+        upper = (CellData.timestamp <= hi_ts if inclusive_end
+                 else CellData.timestamp < hi_ts)
+        flt = [CellData.device_id == device_id,
+               CellData.timestamp >= lo_ts, upper]
+        op_rows = (db.session.query(CellData.operator, db.func.count())
+                   .filter(*flt).group_by(CellData.operator).all())
+        net_rows = (db.session.query(CellData.network_type, db.func.count(),
+                                     db.func.sum(CellData.signal_power),
+                                     db.func.sum(CellData.snr))
+                    .filter(*flt).group_by(CellData.network_type).all())
+        _merge_agg(op_cnt, net_agg, op_rows, net_rows)
+
+    if lo < hi:
+        flt = [CellDataHourly.device_id == device_id,
+               CellDataHourly.hour_ts >= lo, CellDataHourly.hour_ts < hi]
+        op_rows = (db.session.query(CellDataHourly.operator,
+                                    db.func.sum(CellDataHourly.n))
+                   .filter(*flt).group_by(CellDataHourly.operator).all())
+        net_rows = (db.session.query(CellDataHourly.network_type,
+                                     db.func.sum(CellDataHourly.n),
+                                     db.func.sum(CellDataHourly.sum_sig),
+                                     db.func.sum(CellDataHourly.sum_snr))
+                    .filter(*flt).group_by(CellDataHourly.network_type).all())
+        _merge_agg(op_cnt, net_agg, op_rows, net_rows)
+        add_raw(s, lo, False)
+        add_raw(hi, e, True)
+    else:
+        add_raw(s, e, True)
+
+    return op_cnt, net_agg
+
+# Response-level cache: dashboards poll the stats endpoints with identical
+# query strings. Keys include the latest ingest timestamp (from the bounds
+# cache) so new data implicitly invalidates stale entries.
+_STATS_CACHE_TTL = {"device": 10, "global": 30}  # seconds
+_stats_cache = {}
+_stats_cache_lock = threading.Lock()
+
+def _cached_stats(kind, key_parts, compute):
+    _, latest = _ts_bounds()
+    key = (kind,) + key_parts + (latest,)
+    now = time.monotonic()
+    with _stats_cache_lock:
+        hit = _stats_cache.get(key)
+        if hit and now < hit[0]:
+            return hit[1]
+    result = compute()
+    with _stats_cache_lock:
+        _stats_cache[key] = (now + _STATS_CACHE_TTL[kind], result)
+        if len(_stats_cache) > 256:  # evict expired entries, bound memory
+            for k in [k for k, v in _stats_cache.items() if v[0] < now]:
+                _stats_cache.pop(k, None)
+    return result
+
+def get_stats_cached(device_id, start=None, end=None):
+    return _cached_stats("device", (device_id, start, end),
+                         lambda: get_stats_inner(device_id, start, end))
+
+def avg_all_cached(start=None, end=None):
+    return _cached_stats("global", (start, end),
+                         lambda: avg_all_inner(start, end))
+
+def _pct(v, total):
+    # integer-only "NN.NN%" formatting: scale to hundredths of a percent,
+    # round half up with the +total//2 bias — no float ops, no round()
+    p = (v * 10000 + total // 2) // total
+    return f"{p//100}.{p%100:02d}%"
 
-    rows = (CellData.query.filter_by(device_id=device_id)
-            .filter(CellData.timestamp.between(s,e)).all())
-    if not rows:
-        return {"message":"No data"},404
+def get_stats_inner(device_id, start=None, end=None):
+    rng = _parse_range(start, end)
+    if isinstance(rng[0], dict):
+        return rng
+    s, e = rng
 
-    total=len(rows); op_cnt={}; net_cnt={}; sig_net={}; snr_net={}; sig_dev=[]
-    for r in rows:
-        op_cnt[r.operator]=op_cnt.get(r.operator,0)+1
-        net_cnt[r.network_type]=net_cnt.get(r.network_type,0)+1
-        sig_net.setdefault(r.network_type,[]).append(r.signal_power)
-        snr_net.setdefault(r.network_type,[]).append(r.snr)
-        sig_dev.append(r.signal_power)
+    op_cnt, net_agg = _device_aggregates(device_id, s, e)
+    if not op_cnt:
+        return {"message":"No data"},404
+    total = sum(op_cnt.values())
 
     return {
-        "connectivity_per_operator":{k:f"{round(v/total*100,2)}%" for k,v in op_cnt.items()},
-        "connectivity_per_network_type":{k:f"{round(v/total*100,2)}%" for k,v in net_cnt.items()},
-        "avg_signal_per_network_type":{k:round(sum(v)/len(v),2) for k,v in sig_net.items()},
-        "avg_snr_per_network_type":{k:round(sum(v)/len(v),2) for k,v in snr_net.items()},
-        "avg_signal_device":round(sum(sig_dev)/len(sig_dev),2),
+        "connectivity_per_operator":{k:_pct(v,total) for k,v in op_cnt.items()},
+        "connectivity_per_network_type":{k:_pct(a[0],total) for k,a in net_agg.items()},
+        "avg_signal_per_network_type":{k:round(a[1]/a[0],2) for k,a in net_agg.items()},
+        "avg_snr_per_network_type":{k:round(a[2]/a[0],2) for k,a in net_agg.items()},
+        "avg_signal_device":round(sum(a[1] for a in net_agg.values())/total,2),
     },200
 
 def avg_all_inner(start=None, end=None):
-    first = db.session.query(db.func.min(CellData.timestamp)).scalar()
-    last  = db.session.query(db.func.max(CellData.timestamp)).scalar()
-    if first is None:
-        return {"message":"No data"},404
-
-    s,e = _to_utc(start,first), _to_utc(end,last)
-    if e < s:
-        return {"error":"End date must be after start date"},400
+    rng = _parse_range(start, end)
+    if isinstance(rng[0], dict):
+        return rng
+    s, e = rng
+
+    # Same rollup-plus-edges split as the per-device path, across devices.
+    n = sig = snr = 0
+    lo, hi = _hour_ceil(s), _hour_floor(e)
+
+    def add(row):
+        nonlocal n, sig, snr
+        if row and row[0]:
+            n   += row[0]
+            sig += row[1] or 0
+            snr += row[2] or 0.0
+
+    def raw(lo_ts, hi_ts, inclusive_end):
+        upper = (CellData.timestamp <= hi_ts if inclusive_end
+                 else CellData.timestamp < hi_ts)
+        return (db.session.query(db.func.count(),
+                                 db.func.sum(CellData.signal_power),
+                                 db.func.sum(CellData.snr))
+                .filter(CellData.timestamp >= lo_ts, upper).first())
+
+    if lo < hi:
+        add(db.session.query(db.func.sum(CellDataHourly.n),
+                             db.func.sum(CellDataHourly.sum_sig),
+                             db.func.sum(CellDataHourly.sum_snr))
+            .filter(CellDataHourly.hour_ts >= lo, CellDataHourly.hour_ts < hi)
+            .first())
+        add(raw(s, lo, False))
+        add(raw(hi, e, True))
+    else:
+        add(raw(s, e, True))
 
-    avg_sig,avg_snr = (CellData.query.with_entities(
-        db.func.avg(CellData.signal_power), db.func.avg(CellData.snr))
-        .filter(CellData.timestamp.between(s,e)).first())
+    if n == 0:
+        return {"avg_signal_all_devices":0, "avg_snr_all_devices":0},200
     return {
-        "avg_signal_all_devices":round(avg_sig or 0,2),
-        "avg_snr_all_devices":round(avg_snr or 0,2)
+        "avg_signal_all_devices":round(sig/n,2),
+        "avg_snr_all_devices":round(snr/n,2)
     },200
 
+@app.template_filter("beirut")
+def _fmt_beirut(dt):
+    """Render a stored naive-UTC datetime in Beirut local time.
+
+    Formatting happens lazily at template render, so only rows that are
+    actually rendered pay the tz conversion.
+    """
+    return (dt.replace(tzinfo=utc_tz).astimezone(lebanon_tz)
+              .strftime("%d %b %Y %I:%M %p"))
+
+def ojson(obj, code=200):
+    """orjson-backed jsonify: C-speed serialization, emits bytes directly."""
+    return app.response_class(orjson.dumps(obj), status=code,
+                              mimetype="application/json")
+
 # ───────────────────────────────────────
 # ROUTES
 # ───────────────────────────────────────
@@ -126,51 +508,43 @@ def index():
 # ---------- RECEIVE DATA ----------
 @app.route("/receive-data", methods=["POST"])
 def receive_data():
-    data = request.get_json(force=True)
     try:
+        # orjson.loads on the raw bytes: skips Werkzeug's content-type dance
+        # and stdlib json; cache=False avoids keeping a copy of the body
+        data = orjson.loads(request.get_data(cache=False))
         device_id     = data["device_id"]                 # required
         operator      = data["operator"]
         signal_power  = int(data["signal_power"])
         network_type  = data["network_type"]
         cell_id       = data["cell_id"]
-        ts_local      = lebanon_tz.localize(
-            datetime.strptime(data["timestamp"], "%d %b %Y %I:%M %p")
-        )
-        ts_utc        = ts_local.astimezone(pytz.utc)
+        ts_local      = parse_ts(data["timestamp"]).replace(tzinfo=lebanon_tz)
+        ts_utc        = ts_local.astimezone(utc_tz)
 
         band = data.get("band", "N/A")
         snr  = float(data.get("snr", 0.0))
 
-        db.session.add(
-            CellData(
-                device_id=device_id,
-                operator=operator,
-                signal_power=signal_power,
-                snr=snr,
-                network_type=network_type,
-                band=band,
-                cell_id=cell_id,
-                timestamp=ts_utc,
-            )
-        )
-
-        # update "online devices" table (dashboard)
         client_ip = request.headers.get("X-Forwarded-For", request.remote_addr).split(",")[0]
-        now_utc   = datetime.utcnow()
-        dev = DeviceLog.query.filter_by(ip_address=client_ip).first()
-        if dev:
-            dev.last_seen = now_utc
-            dev.device_id = device_id  # Update device_id
-        else:
-            db.session.add(DeviceLog(ip_address=client_ip, device_id=device_id, last_seen=now_utc))
-
-        db.session.commit()
-        return jsonify({"message": "Data received"}), 201
+        _ensure_flusher()
+        _ingest_q.put({
+            "row": {
+                "device_id": device_id,
+                "operator": operator,
+                "signal_power": signal_power,
+                "snr": snr,
+                "network_type": network_type,
+                "band": band,
+                "cell_id": cell_id,
+                "timestamp": ts_utc,
+            },
+            "ip": client_ip,
+            "last_seen": datetime.utcnow(),
+        })
+        return ojson({"message": "Data queued"}, 202)
 
     except KeyError as miss:
-        return jsonify({"error": f"Missing field {miss}"}), 400
+        return ojson({"error": f"Missing field {miss}"}, 400)
     except Exception as e:
-        return jsonify({"error": str(e)}), 400
+        return ojson({"error": str(e)}, 400)
 
 # ---------- PER-DEVICE STATS ----------
 @app.route("/get-stats")
@@ -178,123 +552,43 @@ def get_stats():
     try:
         device_id = request.args.get("device_id")
         if not device_id:
-            return jsonify({"error": "device_id is required"}), 400
+            return ojson({"error": "device_id is required"}, 400)
 
-        # --- date parsing
-        s, e = request.args.get("start"), request.args.get("end")
-        first = db.session.query(db.func.min(CellData.timestamp)).scalar()
-        last  = db.session.query(db.func.max(CellData.timestamp)).scalar()
-        if first is None:
-            return jsonify({"message": "No data"}), 404
-
-        def to_utc(date_str, default):
-            if not date_str:
-                return default
-            return lebanon_tz.localize(
-                datetime.strptime(date_str, "%d %b %Y %I:%M %p")
-            ).astimezone(pytz.utc)
-
-        start_utc, end_utc = to_utc(s, first), to_utc(e, last)
-        if end_utc < start_utc:
-            return jsonify({"error": "End date must be after start date"}), 400
-
-        rows = (
-            CellData.query.filter_by(device_id=device_id)
-            .filter(CellData.timestamp.between(start_utc, end_utc))
-            .all()
+        body, code = get_stats_cached(
+            device_id, request.args.get("start"), request.args.get("end")
         )
-        if not rows:
-            return jsonify({"message": "No data for device"}), 404
-
-        # --- aggregation
-        total = len(rows)
-        op_cnt, net_cnt, sig_net, snr_net = {}, {}, {}, {}
-        sig_device = []
-        for r in rows:
-            op_cnt[r.operator] = op_cnt.get(r.operator, 0) + 1
-            net_cnt[r.network_type] = net_cnt.get(r.network_type, 0) + 1
-            sig_net.setdefault(r.network_type, []).append(r.signal_power)
-            snr_net.setdefault(r.network_type, []).append(r.snr)
-            sig_device.append(r.signal_power)
-
-        return jsonify(
-            {
-                "connectivity_per_operator": {
-                    k: f"{round(v/total*100,2)}%" for k, v in op_cnt.items()
-                },
-                "connectivity_per_network_type": {
-                    k: f"{round(v/total*100,2)}%" for k, v in net_cnt.items()
-                },
-                "avg_signal_per_network_type": {
-                    k: round(sum(v)/len(v), 2) for k, v in sig_net.items()
-                },
-                "avg_snr_per_network_type": {
-                    k: round(sum(v)/len(v), 2) for k, v in snr_net.items()
-                },
-                "avg_signal_device": round(sum(sig_device)/len(sig_device), 2),
-            }
-        ), 200
+        return ojson(body, code)
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 400
+        return ojson({"error": str(e)}, 400)
 
 # ---------- CROSS-DEVICE AVERAGES ----------
 @app.route("/get-stats/avg-all")
 def avg_all():
     try:
-        s, e = request.args.get("start"), request.args.get("end")
-        first = db.session.query(db.func.min(CellData.timestamp)).scalar()
-        last  = db.session.query(db.func.max(CellData.timestamp)).scalar()
-        if first is None:
-            return jsonify({"message": "No data"}), 404
-
-        start_utc = first if not s else lebanon_tz.localize(
-            datetime.strptime(s, "%d %b %Y %I:%M %p")
-        ).astimezone(pytz.utc)
-        end_utc   = last  if not e else lebanon_tz.localize(
-            datetime.strptime(e, "%d %b %Y %I:%M %p")
-        ).astimezone(pytz.utc)
-
-        if end_utc < start_utc:
-            return jsonify({"error": "End date must be after start date"}), 400
-
-        avg_sig, avg_snr = (
-            CellData.query.with_entities(
-                db.func.avg(CellData.signal_power),
-                db.func.avg(CellData.snr),
-            )
-            .filter(CellData.timestamp.between(start_utc, end_utc))
-            .first()
-        )
-        return (
-            jsonify(
-                {
-                    "avg_signal_all_devices": round(avg_sig or 0, 2),
-                    "avg_snr_all_devices": round(avg_snr or 0, 2),
-                }
-            ),
-            200,
+        body, code = avg_all_cached(
+            request.args.get("start"), request.args.get("end")
         )
+        return ojson(body, code)
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 400
+        return ojson({"error": str(e)}, 400)
 
 # ---------- DASHBOARD (unchanged) ----------
 @app.route("/central-stats")
 def central_stats():
-    devices = DeviceLog.query.all()
+    # tuple fetch: no DeviceLog instances, just the two columns we render
+    rows = db.session.query(DeviceLog.ip_address, DeviceLog.last_seen).all()
     device_list = [
         {
-            "ip": d.ip_address,
-            "last_seen": d.last_seen.astimezone(lebanon_tz).strftime(
-                "%d %b %Y %I:%M %p"
-            ),
-            "device_id": d.ip_address  # Use IP as device_id for now
+            "ip": ip,
+            "last_seen": last_seen,  # formatted lazily by the |beirut filter
+            "device_id": ip  # Use IP as device_id for now
         }
-        for d in devices
+        for ip, last_seen in rows
     ]
     return render_template(
-        "central_stats.html", total_devices=len(devices), devices=device_list
+        "central_stats.html", total_devices=len(rows), devices=device_list
     )
 
 @app.route("/device-stats")
@@ -305,27 +599,21 @@ def device_stats_page():
 
     if device_id == "global":
         # call the existing global-avg logic
-        stats = avg_all_inner(start, end)     # helper returns dict
+        stats = avg_all_cached(start, end)    # helper returns (dict, code)
     else:
-        # Try to find data using device_id directly
-        data = CellData.query.filter_by(device_id=device_id).first()
-        
-        if data:
-            # If we found data directly with device_id
-            stats = get_stats_inner(device_id, start, end)
+        # One COALESCE query replaces the old three-step fallback chain:
+        # exact device_id match, then DeviceLog by IP, then newest data.
+        resolved = db.session.execute(text(
+            "SELECT COALESCE("
+            "(SELECT device_id FROM cell_data WHERE device_id = :q LIMIT 1), "
+            "(SELECT device_id FROM device_log WHERE ip_address = :q), "
+            "(SELECT device_id FROM cell_data ORDER BY timestamp DESC LIMIT 1))"
+        ), {"q": device_id}).scalar()
+
+        if resolved:
+            stats = get_stats_cached(resolved, start, end)
         else:
-            # Try to find device_id based on IP
-            device_log = DeviceLog.query.filter_by(ip_address=device_id).first()
-            if device_log and device_log.device_id:
-                # Use the stored device_id from the log
-                stats = get_stats_inner(device_log.device_id, start, end)
-            else:
-                # Last resort - use most recent data
-                recent_data = CellData.query.order_by(CellData.timestamp.desc()).first()
-                if recent_data:
-                    stats = get_stats_inner(recent_data.device_id, start, end)
-                else:
-                    stats = ({"error": "No data available for this device"}, 404)
+            stats = ({"error": "No data available for this device"}, 404)
 
     if isinstance(stats, tuple):  # existing helpers return (json, code)
         stats, code = stats
@@ -338,4 +626,6 @@ def device_stats_page():
 # MAIN
 # ───────────────────────────────────────
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
+    # Local development only. Production runs under gunicorn (see Procfile):
+    # one worker because SQLite locks per process, gthread for I/O concurrency.
+    app.run(host="0.0.0.0", port=5000, threaded=True)